@@ -10,11 +10,12 @@ in-memory consumption and execution time.
 """
 
 import datetime
-import ijson
-import io
+import mmap
 import os
+import re
 import shutil
-import glob
+from array import array
+from collections import OrderedDict, deque
 
 # File Constants
 # Input
@@ -24,10 +25,42 @@ INPUT_FILE = 'ctl_records_sample.jsonlines'
 # Output
 OUTPUT_DIRECTORY = "output"
 JSONLINE_EXTENSION = '.jsonline'
+OUTPUT_FILE_CACHE_SIZE = 512  # Maximum number of fingerprint output files kept open at once
+WRITE_BUFFER_SIZE = 64 << 20  # Pending duplicate bytes held in memory before they are flushed to disk
+COPY_BUFFER_SIZE = 1 << 20  # Number of bytes copied at once while merging
+MERGE_QUEUE_DEPTH = 8  # Number of fingerprint files whose reads are queued ahead of the one being merged
 
 # Constants
-TAG_NEW = "NW"  # Tags the fingerprint when it is encountered for the first time
-TAG_EXISTING = "EX"  # Tags the fingerprint as already seen
+LENGTH_BITS = 32  # Bits of a packed first occurrence that hold the length of the json object line
+LENGTH_MASK = (1 << LENGTH_BITS) - 1
+PREFILTER_MIN_SIZE = 256 << 20  # Inputs smaller than this keep every single fingerprint in memory in one pass
+BLOOM_INPUT_BYTES_PER_SLOT = 64  # Input bytes per slot of the Bloom filter that prefilters repeated fingerprints
+BLOOM_MIN_SLOTS = 1 << 16
+BLOOM_MAX_COUNT = 2  # Slot counts saturate here, enough to tell a repeated fingerprint from a single one
+
+# Keys located with bytes.find in a raw json line, the fingerprint of the leaf certificate is the first
+# fingerprint key after leaf_cert (skipping the nested subject and extensions objects)
+LEAF_CERT_KEY = b'"leaf_cert"'
+FINGER_PRINT_KEY = b'"fingerprint"'
+# Matches the fingerprint value right after its key
+FP_VALUE_RE = re.compile(rb'\s*:\s*"([^"]+)"')
+
+# The hashmap key of a fingerprint is packed from its leading hex digits, which span at most
+# FP_KEY_SPAN bytes of a colon separated fingerprint
+FP_KEY_HEX_DIGITS = 16
+FP_KEY_SPAN = FP_KEY_HEX_DIGITS + FP_KEY_HEX_DIGITS // 2 - 1
+
+# Source of a fingerprint extractor specialized for the layout of the input, the key prefix and length of
+# the fingerprint value are filled in from a sample line. The first fingerprint key after leaf_cert has to start
+# the key prefix, lines that do not fit the layout fall back to find_finger_print
+FINGER_PRINT_EXTRACTOR_SOURCE = '''
+def extract_finger_print(buf, start, end):
+    key = buf.find({finger_print_key!r}, buf.find({leaf_cert_key!r}, start, end), end)
+    value = key + {prefix_length}
+    if key >= 0 and buf[key:value] == {prefix!r} and buf.find(b'"', value, end) == value + {length}:
+        return buf[value:value + {length}]
+    return find_finger_print(buf, start, end)
+'''
 
 
 def print_to_console(message):
@@ -51,29 +84,233 @@ def clean_directory(directory):
         shutil.rmtree(directory)
 
 
-class MapValue(object):
+def get_finger_print_key(finger_print, offset):
     """
-    The values in the fingerprint hashmap are of this class type. This object is used to aid in the process of
-    identifying duplicates in the input file
+    Packs the leading 8 bytes of a hex fingerprint into an int used as the hashmap key. A small int
+    takes far less memory than the fingerprint string and is hashed in constant time. Distinct fingerprints
+    sharing their leading 8 bytes get the same key, so a key does not identify a fingerprint on its own
+    :param finger_print: Colon separated hex fingerprint in bytes
+    :param offset: Start offset of the json object line of the fingerprint, reported when it is not hex
+    :return: 64 bit int key of the fingerprint
     """
 
-    __slots__ = ['start', 'length', 'tag', 'path', 'end_offset']
+    # Only the leading bytes that can hold the 16 hex digits and their separators are stripped and parsed,
+    # instead of copying the whole fingerprint
+    try:
+        return int(finger_print[:FP_KEY_SPAN].translate(None, b':')[:FP_KEY_HEX_DIGITS], 16)
+    except ValueError:
+        raise Exception('Fingerprint {0} of json object at offset {1} is not hexadecimal'.format(
+            finger_print.decode(errors='replace'), offset))
 
-    def __init__(self, start, length, tag, path, end_offset):
+
+def copy_file_bytes(readfile, outfile, size):
+    """
+    Copies the first size bytes of a file to another file. The copy is done inside the kernel with sendfile
+    where it is supported, otherwise it goes through a user space buffer
+    :param readfile: File opened in binary read mode
+    :param outfile: Unbuffered file opened in binary write mode
+    :param size: Number of bytes to copy
+    """
+
+    offset = 0
+    if hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                sent = os.sendfile(outfile.fileno(), readfile.fileno(), offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+            return
+        except OSError:
+            # Some platforms (e.g. macOS) only send to sockets, the rest is copied below
+            pass
+
+    readfile.seek(offset)
+    size -= offset
+    while size > 0:
+        chunk = readfile.read(min(size, COPY_BUFFER_SIZE))
+        if not chunk:
+            break
+        outfile.write(chunk)
+        size -= len(chunk)
+
+
+def open_with_readahead(paths, queue_depth=MERGE_QUEUE_DEPTH):
+    """
+    Opens the files ahead of the caller and asks the kernel to start reading them in the background, so
+    up to queue_depth reads are in flight while the current file is copied. Files just written are usually
+    still in the page cache, where this costs next to nothing, it pays off once they have been evicted.
+    Platforms without posix_fadvise simply open the files in order
+    :param paths: Filenames to open
+    :param queue_depth: Number of files opened ahead of the one being consumed
+    :return: yields each file opened in binary read mode, the caller closes it
+    """
+
+    pending = deque()
+    try:
+        for path in paths:
+            readfile = open(path, 'rb')
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(readfile.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            pending.append(readfile)
+
+            if len(pending) >= queue_depth:
+                yield pending.popleft()
+
+        while pending:
+            yield pending.popleft()
+    finally:
+        # Files that were opened ahead but never handed out
+        for readfile in pending:
+            readfile.close()
+
+
+def match_finger_print(buf, start, end):
+    """
+    Matches the leaf certificate fingerprint value of the json object line buf[start:end] without parsing the json
+    :param buf: Input bytes or memory mapped input
+    :param start: Start offset of the json object line
+    :param end: End offset of the json object line
+    :return: match of FP_VALUE_RE starting right after the fingerprint key, the fingerprint is its first group
+    """
+
+    leaf_cert = buf.find(LEAF_CERT_KEY, start, end)
+    key = buf.find(FINGER_PRINT_KEY, leaf_cert, end) if leaf_cert >= 0 else -1
+    while key >= 0:
+        match = FP_VALUE_RE.match(buf, key + len(FINGER_PRINT_KEY), end)
+        if match:
+            return match
+        key = buf.find(FINGER_PRINT_KEY, key + 1, end)
+
+    raise Exception('Fingerprint not found in json object at offset {0}'.format(start))
+
+
+def find_finger_print(buf, start, end):
+    """
+    Finds the leaf certificate fingerprint of the json object line buf[start:end] without parsing the json
+    :param buf: Input bytes or memory mapped input
+    :param start: Start offset of the json object line
+    :param end: End offset of the json object line
+    :return: fingerprint in bytes
+    """
+
+    return match_finger_print(buf, start, end).group(1)
+
+
+def build_finger_print_extractor(sample_line):
+    """
+    Generates a fingerprint extractor specialized for the layout of a sample json line. It finds the exact
+    fingerprint key prefix of the sample and copies a fixed length value, which avoids the regex engine
+    :param sample_line: A json object line of the input
+    :return: function with the signature of find_finger_print
+    """
+
+    try:
+        match = match_finger_print(sample_line, 0, len(sample_line))
+    except Exception:
+        return find_finger_print
+
+    # The prefix is sliced from the match of the generic lookup, from its fingerprint key up to the value, so the
+    # specialized extractor looks for the same key the generic lookup found
+    prefix = sample_line[match.start() - len(FINGER_PRINT_KEY):match.start(1)]
+
+    source = FINGER_PRINT_EXTRACTOR_SOURCE.format(prefix=prefix, leaf_cert_key=LEAF_CERT_KEY,
+                                                  finger_print_key=FINGER_PRINT_KEY, prefix_length=len(prefix),
+                                                  length=len(match.group(1)))
+    namespace = {'find_finger_print': find_finger_print}
+    exec(compile(source, '<finger_print_extractor>', 'exec'), namespace)
+    return namespace['extract_finger_print']
+
+
+def scan_lines(buf):
+    """
+    Walks the memory mapped input line by line with bytes.find, so no bytes object is created per line
+    :param buf: Input bytes or memory mapped input
+    :return: yields (start offset, end offset) for every line of the input, the end offset excludes the
+    trailing newline (and carriage return) so the json object needs no stripping later
+    """
+
+    size = len(buf)
+    start = 0
+    while start < size:
+        newline = buf.find(b'\n', start)
+        if newline < 0:
+            newline = size
+        end = newline
+        if end > start and buf[end - 1] == 13:
+            end -= 1
+        yield start, end
+        start = newline + 1
+
+
+def scan_repeated_lines(buf, extract_finger_print):
+    """
+    Walks the input twice to leave out the lines whose fingerprint certainly occurs once. The first pass counts
+    the fingerprints in a Bloom filter and keeps the fingerprint hash of every line, 8 bytes a line, and the
+    second pass walks the lines again without extracting their fingerprints. The second walk costs a full scan
+    of the input, which pays off only once the single fingerprints would take too much memory
+    :param buf: Input bytes or memory mapped input
+    :param extract_finger_print: Fingerprint extractor of the input
+    :return: yields (start offset, end offset) for every line of the input whose fingerprint may repeat
+    """
+
+    repeated = BloomFilter(len(buf))
+    line_hashes = array('q')
+    for start, end in scan_lines(buf):
+        finger_print_hash = hash(extract_finger_print(buf, start, end))
+        line_hashes.append(finger_print_hash)
+        repeated.add(finger_print_hash)
+
+    for line, finger_print_hash in zip(scan_lines(buf), line_hashes):
+        if finger_print_hash in repeated:
+            yield line
+
+
+class BloomFilter(object):
+    """
+    Counting Bloom filter over fingerprint hashes, used to tell fingerprints that may repeat apart from
+    those that certainly occur only once. Each fingerprint hash is counted in two byte slots, one per half
+    of the hash, which keeps a probe to a single bytearray index
+    """
+
+    __slots__ = ['counts', 'mask']
+
+    def __init__(self, input_size):
         """
-        Constructor for the map value class
-        :param start: Start offset of the json object line
-        :param length: Length of the json object line
-        :param tag: Tag indicating if fingerprint is new or seen
-        :param path: Outuput filename of a fingerprint
-        :param end_offset: End offset of a fingerprint in the output destination file
+        Constructor for the Bloom filter class
+        :param input_size: Size of the input in bytes, the number of slots is scaled from it to a power of two
         """
 
-        self.start = start
-        self.length = length
-        self.tag = tag
-        self.path = path
-        self.end_offset = end_offset
+        size = BLOOM_MIN_SLOTS
+        while size * BLOOM_INPUT_BYTES_PER_SLOT < input_size:
+            size <<= 1
+
+        self.counts = bytearray(size)
+        self.mask = size - 1
+
+    def add(self, finger_print_hash):
+        """
+        Counts a fingerprint hash in the filter
+        :param finger_print_hash: hash of the fingerprint
+        """
+
+        counts = self.counts
+        position = finger_print_hash & self.mask
+        if counts[position] < BLOOM_MAX_COUNT:
+            counts[position] += 1
+        position = (finger_print_hash >> 32) & self.mask
+        if counts[position] < BLOOM_MAX_COUNT:
+            counts[position] += 1
+
+    def __contains__(self, finger_print_hash):
+        """
+        Tells if a fingerprint hash may have been added more than once, False if it certainly was not
+        :param finger_print_hash: hash of the fingerprint
+        """
+
+        counts = self.counts
+        return (counts[finger_print_hash & self.mask] >= BLOOM_MAX_COUNT and
+                counts[(finger_print_hash >> 32) & self.mask] >= BLOOM_MAX_COUNT)
 
 
 class CertificateDuplicateIdentifier(object):
@@ -87,47 +324,163 @@ class CertificateDuplicateIdentifier(object):
         self.temp_directory = "temp"
         self.output_directory = "output"
 
+        # Fingerprints seen only once so far map to the packed start offset and length of their json object
+        # line. Most fingerprints never repeat, so they cost a single int and no row in the arrays below
+        self.first_occurrences = {}
+
+        # The fingerprint hashmap maps the key of a duplicated fingerprint to a row in the arrays below. Keeping
+        # each field in a flat array instead of an object per fingerprint avoids the per object overhead
         self.finger_print_map = {}
+        self.finger_prints = []  # Fingerprint of a row, to tell apart distinct fingerprints sharing a key
+        self.paths = []  # Output filename of a fingerprint, in bytes
+        self.end_offsets = array('Q')  # End offset of a fingerprint in the output destination file
+
+        # Fingerprints whose key is already taken by a different fingerprint are kept apart, keyed by the whole
+        # fingerprint. They are handled like the ones above, first occurrences until they repeat and rows after
+        self.collided_first_occurrences = {}
+        self.collided_finger_print_map = {}
+
+        # Input file mapped for the whole run and the most recently used fingerprint output files
+        self._input_mm = None
+        self._input_view = None
+        self._out_cache = OrderedDict()
+
+        # Pending output bytes of each fingerprint row, written out in one call per fingerprint when flushed
+        self._wbuf = {}
+        self._wbuf_total = 0
 
-    def append(self, finger_print, map_val, current_obj):
+        # Prefix and suffix of the fingerprint output filenames, set once the temporary directory is known
+        self._temp_path_prefix = b''
+        self._temp_path_suffix = b''
 
+    def get_output_fp(self, path):
         """
-        Append method that writes the duplicate json objects for a corresponding fingerprint
+        Returns an open handle for a fingerprint output file, reusing a cached one when possible.
+        The least recently used handle is closed once the cache is full
+        :param path: Output filename of a fingerprint
+        :return: file object opened for appending in binary mode
+        """
+
+        temp_fp = self._out_cache.get(path)
+        if temp_fp is not None:
+            self._out_cache.move_to_end(path)
+            return temp_fp
+
+        if len(self._out_cache) >= OUTPUT_FILE_CACHE_SIZE:
+            _, evicted_fp = self._out_cache.popitem(last=False)
+            evicted_fp.close()
+
+        temp_fp = open(path, mode='ab')
+        self._out_cache[path] = temp_fp
+        return temp_fp
+
+    def close_files(self):
+        """
+        Unmaps the input file and closes every cached fingerprint output file
+        """
+
+        if self._input_mm is not None:
+            # The view has to be released before the mapping can be closed. A slice still referenced by an
+            # exception traceback keeps the mapping open until it is garbage collected
+            self._input_view.release()
+            self._input_view = None
+            try:
+                self._input_mm.close()
+            except BufferError:
+                pass
+            self._input_mm = None
+
+        for temp_fp in self._out_cache.values():
+            temp_fp.close()
+        self._out_cache.clear()
+
+    def flush(self):
+        """
+        Writes the pending duplicates of every fingerprint to its output file and empties the write buffer
+        """
+
+        for row, buf in self._wbuf.items():
+            temp_fp = self.get_output_fp(self.paths[row])
+            temp_fp.write(buf)
+
+        self._wbuf.clear()
+        self._wbuf_total = 0
+
+    def append(self, finger_print, row, current_obj, first_obj=None):
+
+        """
+        Append method that buffers the duplicate json objects for a corresponding fingerprint
         given that
         1) if it has already been written for this fingerprint
-        2) else it is being written for the first time
+        2) else it is being written for the first time, along with the first object
+        The buffered objects are written to the fingerprint output file once the write buffer is full
         :param finger_print: fingerprint of certificate based on which the duplicates are identified
-        :param map_val: hash map value for the input fingerprint
+        :param row: hash map row of the input fingerprint
         :param current_obj: new json object being read for the fingerprint
-        :return: returns the final position offset of a fingerprint output file
+        :param first_obj: first json object of the fingerprint when its first duplicate is written
         """
 
-        current_obj = current_obj.decode()
-        finger_print_filename = map_val.path
+        buf = self._wbuf.get(row)
+        if buf is None:
+            buf = self._wbuf[row] = bytearray()
+        size = len(buf)
+
+        if first_obj is not None:
+            # Creates text in the desired output format, uses string concatenation to
+            # avoid usage of json loads and dumps. The closing brackets are written once while merging
+            buf += b'{"fingerprint": "%s", "certificates": [' % finger_print
+            buf += first_obj
+            buf += b","
+
+        # Append a new duplicate json object to the end of the fingerprint output
+        buf += current_obj
+        buf += b","
+
+        # The end offset of the fingerprint output file is tracked here rather than asking the file with tell()
+        written = len(buf) - size
+        self.end_offsets[row] += written
+        self._wbuf_total += written
+        if self._wbuf_total > WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def add_row(self, finger_print):
+        """
+        Adds a hashmap row for a fingerprint at its first duplicate. The output file of a fingerprint is named
+        after its hashmap row
+        :param finger_print: fingerprint of certificate based on which the duplicates are identified
+        :return: the new hashmap row
+        """
+
+        row = len(self.paths)
+        self.finger_prints.append(finger_print)
+        self.paths.append(self._temp_path_prefix + b'%d' % row + self._temp_path_suffix)
+        self.end_offsets.append(0)
+        return row
 
-        if map_val.tag == TAG_NEW:
-            with open(self.input_file, mode='r') as temp_input_file_fp:
+    def append_collided(self, finger_print, start, end):
+        """
+        Records a json object whose fingerprint shares its key with a different fingerprint, keyed by the whole
+        fingerprint instead
+        :param finger_print: fingerprint of certificate based on which the duplicates are identified
+        :param start: Start offset of the json object line
+        :param end: End offset of the json object line
+        """
 
-                # Read the first object from input
-                temp_input_file_fp.seek(map_val.start)
-                first_obj = temp_input_file_fp.read(map_val.length)
+        row = self.collided_finger_print_map.get(finger_print)
+        if row is not None:
+            self.append(finger_print, row, self._input_view[start:end])
+            return
 
-                # Creates text in the desired output format, uses string concatenation to
-                # avoid usage of json loads and dumps
-                temp_text = '{"fingerprint": "%s", "certificates": [' % finger_print
+        first_occurrence = self.collided_first_occurrences.pop(finger_print, None)
+        if first_occurrence is None:
+            self.collided_first_occurrences[finger_print] = (start << LENGTH_BITS) | (end - start)
+            return
 
-                # Creates an output file for a fingerprint when a duplicate has been identified for the first time
-                with open(finger_print_filename, mode='w') as temp_fp:
-                    temp_str = temp_text + first_obj.rstrip() + "," + current_obj.rstrip() + "]}" + "\n"
-                    temp_fp.write(temp_str)
-                    return temp_fp.tell()
-        else:
-            end = map_val.end_offset
-            # Append a new duplicate json object to an existing fingerprint output file
-            with open(finger_print_filename, mode='r+') as temp_input_file_fp:
-                temp_input_file_fp.seek(end - 3)
-                temp_input_file_fp.write(',' + current_obj.rstrip() + ']}' + "\n")
-                return temp_input_file_fp.tell()
+        row = self.add_row(finger_print)
+        self.collided_finger_print_map[finger_print] = row
+        first_start = first_occurrence >> LENGTH_BITS
+        first_end = first_start + (first_occurrence & LENGTH_MASK)
+        self.append(finger_print, row, self._input_view[start:end], self._input_view[first_start:first_end])
 
     def process_data(self, input_file, output_directory="", output_file=""):
         """
@@ -156,53 +509,78 @@ class CertificateDuplicateIdentifier(object):
         self.input_file = input_file
         self.output_file = get_file_path(output_directory, self.output_file, JSONLINE_EXTENSION)
 
+        # Fingerprint output filenames are built from a cached bytes prefix and suffix, which open() accepts as is
+        self._temp_path_prefix = os.fsencode(get_file_path(self.temp_directory, ""))
+        self._temp_path_suffix = os.fsencode(JSONLINE_EXTENSION)
+
         start_time = datetime.datetime.now()
 
         print_to_console("Data processing started at: {0}".format(start_time))
 
         # Process input
-        with open(self.input_file, mode='rb') as input_file_fp:
-
-            start = input_file_fp.tell()
-            line = input_file_fp.readline()
-            count = 0
-            while line:
-                # While loop that reads input line by line until end of the file
-
-                end = input_file_fp.tell()
-
-                # Retrieve fingerprint from the json object using ijson (avoids using json loads for faster execution)
-                finger_print_str = list(ijson.items(io.BytesIO(line), 'data.leaf_cert'))[0]['fingerprint']
-
-                # Length of the json object
-                length = end - start
-
-                if finger_print_str in self.finger_print_map:
-                    map_value = self.finger_print_map[finger_print_str]
-
-                    # Tag check to verify if fingerprint has already been seen or written to output
-                    if map_value.tag == TAG_NEW:
-
-                        # Number of unique fingerprints
-                        count += 1
-                        path = get_file_path(self.temp_directory, str(count), JSONLINE_EXTENSION)
-                        map_value.path = path
-
-                        end = self.append(finger_print_str, map_value, line)
-                        map_value.end_offset = end
-                        map_value.tag = TAG_EXISTING
-                        self.finger_print_map[finger_print_str] = map_value
+        try:
+            # The input is memory mapped to scan it and to read back the first object of a fingerprint when its
+            # duplicate is found, an empty input has no lines and cannot be memory mapped
+            with open(self.input_file, mode='rb') as input_file_fp:
+                if os.fstat(input_file_fp.fileno()).st_size:
+                    self._input_mm = mmap.mmap(input_file_fp.fileno(), 0, access=mmap.ACCESS_READ)
+                    # Slices of a memoryview are copied straight into the write buffer without a bytes copy
+                    self._input_view = memoryview(self._input_mm)
+            input_buf = self._input_mm if self._input_mm is not None else b''
+
+            # The fingerprint extractor is specialized for the layout of the first line
+            start, end = next(scan_lines(input_buf), (0, 0))
+            extract_finger_print = build_finger_print_extractor(input_buf[start:end])
+
+            # Inputs too large to keep every single fingerprint in memory are prefiltered, so the fingerprints
+            # that certainly occur once are skipped instead of remembered until the end
+            if len(input_buf) < PREFILTER_MIN_SIZE:
+                lines = scan_lines(input_buf)
+            else:
+                lines = scan_repeated_lines(input_buf, extract_finger_print)
+
+            for start, end in lines:
+                # Loop that reads input line by line until end of the file along with the fingerprint of each
+                # json object, which is found without parsing the json
+                finger_print_str = extract_finger_print(input_buf, start, end)
+
+                finger_print_key = get_finger_print_key(finger_print_str, start)
+
+                row = self.finger_print_map.get(finger_print_key)
+                if row is not None:
+                    if self.finger_prints[row] == finger_print_str:
+                        # Fingerprint already written to output
+                        self.append(finger_print_str, row, self._input_view[start:end])
                     else:
-                        end = self.append(finger_print_str, map_value, line)
-                        map_value.end_offset = end
-                        self.finger_print_map[finger_print_str] = map_value
-                else:
-                    map_value = MapValue(start, length, TAG_NEW, "", "")
-                    self.finger_print_map[finger_print_str] = map_value
-
-                # Offset before reading the next line
-                start = input_file_fp.tell()
-                line = input_file_fp.readline()
+                        # A different fingerprint already owns the key
+                        self.append_collided(finger_print_str, start, end)
+                    continue
+
+                first_occurrence = self.first_occurrences.pop(finger_print_key, None)
+                if first_occurrence is None:
+                    # Fingerprint seen for the first time
+                    self.first_occurrences[finger_print_key] = (start << LENGTH_BITS) | (end - start)
+                    continue
+
+                # The first object shares the key, its fingerprint is read back from the memory mapped input
+                # to make sure it is the same fingerprint
+                first_start = first_occurrence >> LENGTH_BITS
+                first_end = first_start + (first_occurrence & LENGTH_MASK)
+                if extract_finger_print(input_buf, first_start, first_end) != finger_print_str:
+                    self.first_occurrences[finger_print_key] = first_occurrence
+                    self.append_collided(finger_print_str, start, end)
+                    continue
+
+                # First duplicate of a fingerprint, which is promoted to the hashmap
+                row = self.add_row(finger_print_str)
+                self.finger_print_map[finger_print_key] = row
+                self.append(finger_print_str, row, self._input_view[start:end],
+                            self._input_view[first_start:first_end])
+
+            # Write out the duplicates still held in the write buffer
+            self.flush()
+        finally:
+            self.close_files()
 
         print_to_console("Data processed in: {0}".format(datetime.datetime.now() - start_time))
 
@@ -216,11 +594,23 @@ class CertificateDuplicateIdentifier(object):
         start_time = datetime.datetime.now()
         print_to_console("Data cleaning started at: {0}".format(start_time))
 
-        temp_directory_file_paths = self.temp_directory + '/*' + JSONLINE_EXTENSION
-        with open(self.output_file, 'wb') as outfile:
-            for filename in glob.glob(temp_directory_file_paths):
-                with open(filename, 'rb') as readfile:
-                    shutil.copyfileobj(readfile, outfile)
+        # Files are merged in the order of their hashmap rows, i.e. the order of first duplication of the
+        # fingerprints in the input, rather than the arbitrary directory order, so they are read back in the order
+        # they were created
+        with os.scandir(self.temp_directory) as it:
+            entries = sorted((entry for entry in it if entry.name.endswith(JSONLINE_EXTENSION)),
+                             key=lambda entry: int(entry.name[:-len(JSONLINE_EXTENSION)]))
+
+        # The output is unbuffered since sendfile writes to its file descriptor directly
+        with open(self.output_file, 'wb', buffering=0) as outfile:
+            for entry, readfile in zip(entries, open_with_readahead([entry.path for entry in entries])):
+                row = int(entry.name[:-len(JSONLINE_EXTENSION)])
+
+                # Copy everything but the trailing comma of the last duplicate, which the known end offset
+                # of the file allows without seeking or a stat, and close the fingerprint with the closing brackets
+                with readfile:
+                    copy_file_bytes(readfile, outfile, self.end_offsets[row] - 1)
+                outfile.write(b']}\n')
 
         if clear_temp:
             clean_directory(self.temp_directory)
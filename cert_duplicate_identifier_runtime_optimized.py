@@ -8,11 +8,13 @@ on fingerprints. The code maintains a hashmap of duplicate json object positions
 This might lead to scalability issues as the number of unique fingerprints and duplicates increases
 
 """
-import ijson
-import io
 import datetime
+import mmap
+import multiprocessing
 import os
+import re
 import shutil
+from array import array
 
 # File Constants
 # Input
@@ -22,6 +24,36 @@ INPUT_FILE = 'ctl_records_sample.jsonlines'
 # Output
 OUTPUT_DIRECTORY = "output"
 JSONLINE_EXTENSION = '.jsonline'
+WRITE_BUFFER_SIZE = 1 << 20  # Output bytes staged in memory before they are written to the output file
+PARALLEL_MIN_SIZE = 64 << 20  # Inputs smaller than this are scanned in a single process
+PARALLEL_MIN_RANGE_SIZE = 8 << 20  # Smallest byte range of the input scanned by one process
+
+# Keys located with bytes.find in a raw json line, the fingerprint of the leaf certificate is the first
+# fingerprint key after leaf_cert (skipping the nested subject and extensions objects)
+LEAF_CERT_KEY = b'"leaf_cert"'
+FINGER_PRINT_KEY = b'"fingerprint"'
+# Matches the fingerprint value right after its key
+FP_VALUE_RE = re.compile(rb'\s*:\s*"([^"]+)"')
+
+# The hashmap key of a fingerprint is packed from its leading hex digits, which span at most
+# FP_KEY_SPAN bytes of a colon separated fingerprint
+FP_KEY_HEX_DIGITS = 16
+FP_KEY_SPAN = FP_KEY_HEX_DIGITS + FP_KEY_HEX_DIGITS // 2 - 1
+
+# Source of a fingerprint extractor specialized for the layout of the input, the key prefix and length of
+# the fingerprint value are filled in from a sample line. The first fingerprint key after leaf_cert has to start
+# the key prefix, lines that do not fit the layout fall back to find_finger_print
+FINGER_PRINT_EXTRACTOR_SOURCE = '''
+def extract_finger_print(buf, start, end):
+    key = buf.find({finger_print_key!r}, buf.find({leaf_cert_key!r}, start, end), end)
+    value = key + {prefix_length}
+    if key >= 0 and buf[key:value] == {prefix!r} and buf.find(b'"', value, end) == value + {length}:
+        return buf[value:value + {length}]
+    return find_finger_print(buf, start, end)
+'''
+
+# Constants
+END_OF_LINES = -1  # Marks the last json object line of a fingerprint
 
 
 def print_to_console(message):
@@ -40,22 +72,139 @@ def get_file_path(directory, filename, extension=""):
     return directory + "/" + filename + extension
 
 
-class MapValue(object):
+def get_finger_print_key(finger_print, offset):
     """
-    The values in the fingerprint hashmap are of this class type. This object is used to aid in the process of
-    identifying duplicates in the input file
+    Packs the leading 8 bytes of a hex fingerprint into an int used as the hashmap key. A small int
+    takes far less memory than the fingerprint string and is hashed in constant time. Distinct fingerprints
+    sharing their leading 8 bytes get the same key, so a key does not identify a fingerprint on its own
+    :param finger_print: Colon separated hex fingerprint in bytes
+    :param offset: Start offset of the json object line of the fingerprint, reported when it is not hex
+    :return: 64 bit int key of the fingerprint
     """
 
-    __slots__ = ['position_array']
+    # Only the leading bytes that can hold the 16 hex digits and their separators are stripped and parsed,
+    # instead of copying the whole fingerprint
+    try:
+        return int(finger_print[:FP_KEY_SPAN].translate(None, b':')[:FP_KEY_HEX_DIGITS], 16)
+    except ValueError:
+        raise Exception('Fingerprint {0} of json object at offset {1} is not hexadecimal'.format(
+            finger_print.decode(errors='replace'), offset))
 
-    def __init__(self, position_array):
-        """
-        Constructor for the map value class
-        :param position_array: maintains an array of (start, length) tuple which
-        indicates the start offset of the json object and length of it
-        """
 
-        self.position_array = position_array
+def match_finger_print(buf, start, end):
+    """
+    Matches the leaf certificate fingerprint value of the json object line buf[start:end] without parsing the json
+    :param buf: Input bytes or memory mapped input
+    :param start: Start offset of the json object line
+    :param end: End offset of the json object line
+    :return: match of FP_VALUE_RE starting right after the fingerprint key, the fingerprint is its first group
+    """
+
+    leaf_cert = buf.find(LEAF_CERT_KEY, start, end)
+    key = buf.find(FINGER_PRINT_KEY, leaf_cert, end) if leaf_cert >= 0 else -1
+    while key >= 0:
+        match = FP_VALUE_RE.match(buf, key + len(FINGER_PRINT_KEY), end)
+        if match:
+            return match
+        key = buf.find(FINGER_PRINT_KEY, key + 1, end)
+
+    raise Exception('Fingerprint not found in json object at offset {0}'.format(start))
+
+
+def find_finger_print(buf, start, end):
+    """
+    Finds the leaf certificate fingerprint of the json object line buf[start:end] without parsing the json
+    :param buf: Input bytes or memory mapped input
+    :param start: Start offset of the json object line
+    :param end: End offset of the json object line
+    :return: fingerprint in bytes
+    """
+
+    return match_finger_print(buf, start, end).group(1)
+
+
+def build_finger_print_extractor(sample_line):
+    """
+    Generates a fingerprint extractor specialized for the layout of a sample json line. It finds the exact
+    fingerprint key prefix of the sample and copies a fixed length value, which avoids the regex engine
+    :param sample_line: A json object line of the input
+    :return: function with the signature of find_finger_print
+    """
+
+    try:
+        match = match_finger_print(sample_line, 0, len(sample_line))
+    except Exception:
+        return find_finger_print
+
+    # The prefix is sliced from the match of the generic lookup, from its fingerprint key up to the value, so the
+    # specialized extractor looks for the same key the generic lookup found
+    prefix = sample_line[match.start() - len(FINGER_PRINT_KEY):match.start(1)]
+
+    source = FINGER_PRINT_EXTRACTOR_SOURCE.format(prefix=prefix, leaf_cert_key=LEAF_CERT_KEY,
+                                                  finger_print_key=FINGER_PRINT_KEY, prefix_length=len(prefix),
+                                                  length=len(match.group(1)))
+    namespace = {'find_finger_print': find_finger_print}
+    exec(compile(source, '<finger_print_extractor>', 'exec'), namespace)
+    return namespace['extract_finger_print']
+
+
+def scan_finger_prints(buf, start=0, stop=None):
+    """
+    Walks the memory mapped input line by line with bytes.find, so no bytes object is created per line
+    :param buf: Input bytes or memory mapped input
+    :param start: Offset of the first line to scan, must be the start of a line
+    :param stop: Lines starting at or after this offset are not scanned, defaults to the end of the input
+    :return: yields (start offset, end offset, fingerprint) for every line of the input, the end offset
+    excludes the trailing newline (and carriage return) so the json object needs no stripping later
+    """
+
+    size = len(buf)
+    if stop is None:
+        stop = size
+    if start >= stop:
+        return
+
+    # The fingerprint extractor is specialized for the layout of the first line
+    end = buf.find(b'\n', start)
+    extract_finger_print = build_finger_print_extractor(buf[start:size if end < 0 else end])
+
+    while start < stop:
+        newline = buf.find(b'\n', start)
+        if newline < 0:
+            newline = size
+        end = newline
+        if end > start and buf[end - 1] == 13:
+            end -= 1
+        yield start, end, extract_finger_print(buf, start, end)
+        start = newline + 1
+
+
+def scan_range(input_range):
+    """
+    Scans the lines of the input that start within a byte range. Runs in a worker process when the
+    input is scanned in parallel, so only flat arrays are sent back to the parent
+    :param input_range: (input file, range start offset, range end offset)
+    :return: (fingerprint keys, start offsets, lengths) of the json object lines in the range
+    """
+
+    input_file, lo, hi = input_range
+    keys = array('Q')
+    starts = array('Q')
+    lengths = array('I')
+
+    with open(input_file, mode='rb') as input_file_fp, \
+            mmap.mmap(input_file_fp.fileno(), 0, access=mmap.ACCESS_READ) as input_mm:
+        # A range starting inside a line leaves that line to the previous range
+        if lo > 0:
+            newline = input_mm.find(b'\n', lo - 1)
+            lo = newline + 1 if newline >= 0 else hi
+
+        for start, end, finger_print_str in scan_finger_prints(input_mm, lo, hi):
+            keys.append(get_finger_print_key(finger_print_str, start))
+            starts.append(start)
+            lengths.append(end - start)
+
+    return keys, starts, lengths
 
 
 class CertificateDuplicateIdentifier(object):
@@ -64,7 +213,16 @@ class CertificateDuplicateIdentifier(object):
         self.output_file = "duplicate_certificates"
         self.output_directory = "output"
 
+        # The fingerprint hashmap maps a fingerprint key to a row in the per fingerprint arrays. The lines of
+        # a fingerprint are chained through the per line arrays, so no object or list is created per fingerprint
         self.finger_print_map = {}
+        self.counts = array('I')  # Number of json object lines of a fingerprint
+        self.heads = array('Q')  # First json object line of a fingerprint
+        self.tails = array('Q')  # Last json object line of a fingerprint
+
+        self.starts = array('Q')  # Start offset of a json object line
+        self.lengths = array('I')  # Length of a json object line, without the newline
+        self.next_lines = array('q')  # Next json object line with the same fingerprint
 
     def process_data(self, input_file):
         """
@@ -83,36 +241,57 @@ class CertificateDuplicateIdentifier(object):
 
         print_to_console("Data processing started at: {0}".format(start_time))
 
-        # Process input
-        with open(self.input_file, mode='rb') as input_file_fp:
-            start = input_file_fp.tell()
-            line = input_file_fp.readline()
-            while line:
-                # While loop that reads input line by line until end of the file
+        # Process input, an empty input has no lines and cannot be memory mapped
+        size = os.path.getsize(self.input_file)
+        if size < PARALLEL_MIN_SIZE:
+            ranges = [(self.input_file, 0, size)] if size else []
+        else:
+            # The fingerprints of large inputs are found by a pool of processes each scanning a byte range,
+            # only the hashmap updates below are done serially. Only the CPUs this process may run on are counted,
+            # and every range spans at least PARALLEL_MIN_RANGE_SIZE so a small input is not split across many workers
+            if hasattr(os, 'sched_getaffinity'):
+                processes = len(os.sched_getaffinity(0))
+            else:
+                processes = os.cpu_count() or 1
+            processes = max(1, min(processes, size // PARALLEL_MIN_RANGE_SIZE))
+            chunk = -(-size // processes)
+            ranges = [(self.input_file, lo, min(lo + chunk, size)) for lo in range(0, size, chunk)]
+
+        if len(ranges) > 1:
+            with multiprocessing.Pool(len(ranges)) as pool:
+                self.add_lines(pool.imap(scan_range, ranges))
+        else:
+            self.add_lines(map(scan_range, ranges))
 
-                end = input_file_fp.tell()
+        print_to_console("Data processed in: {0}".format(datetime.datetime.now() - start_time))
 
-                # Retrieve fingerprint from the json object using ijson (avoids using json loads for faster execution)
-                finger_print_str = list(ijson.items(io.BytesIO(line), 'data.leaf_cert'))[0]['fingerprint']
+    def add_lines(self, scanned_ranges):
+        """
+        Populates the fingerprint hashmap with the scanned json object lines, in input order
+        :param scanned_ranges: (fingerprint keys, start offsets, lengths) of consecutive byte ranges of the input
+        """
 
-                # Length of the json object
-                length = end - start
+        for keys, starts, lengths in scanned_ranges:
+            line_number = len(self.starts)
+            self.starts.extend(starts)
+            self.lengths.extend(lengths)
+            self.next_lines.extend(array('q', [END_OF_LINES]) * len(keys))
 
+            for finger_print_key in keys:
                 # Checks if fingerprint has already been seen or not
-                if finger_print_str in self.finger_print_map:
-                    map_value = self.finger_print_map[finger_print_str]
-                    map_value.position_array.append((start, length))
-                    self.finger_print_map[finger_print_str] = map_value
+                row = self.finger_print_map.get(finger_print_key)
+                if row is not None:
+                    self.next_lines[self.tails[row]] = line_number
+                    self.tails[row] = line_number
+                    self.counts[row] += 1
 
                 else:
-                    map_value = MapValue([(start, length)])
-                    self.finger_print_map[finger_print_str] = map_value
+                    self.finger_print_map[finger_print_key] = len(self.counts)
+                    self.counts.append(1)
+                    self.heads.append(line_number)
+                    self.tails.append(line_number)
 
-                # Offset before reading the next line
-                start = input_file_fp.tell()
-                line = input_file_fp.readline()
-
-        print_to_console("Data processed in: {0}".format(datetime.datetime.now() - start_time))
+                line_number += 1
 
     def write(self, output_directory="", output_file=""):
         """
@@ -138,21 +317,56 @@ class CertificateDuplicateIdentifier(object):
         self.output_file = get_file_path(output_directory, self.output_file, JSONLINE_EXTENSION)
 
         # Loop through the hashmap and write the duplicates in desired format
-        with open(self.output_file, 'w') as outfile:
-            for finger_print_str, map_val in self.finger_print_map.items():
-
-                # Condition checks if duplicate exists for the fingerprint
-                if len(map_val.position_array) > 1:
-                    text = '{"fingerprint": "%s", "certificates": [' % finger_print_str
-                    for position in map_val.position_array:
-                        start = position[0]
-                        length = position[1]
-                        with open(self.input_file, 'r') as input_file_fp:
-                            input_file_fp.seek(start)
-                            line = input_file_fp.read(length)
-                        text += line.rstrip() + ','
-                    text = text.rstrip(',') + ']}' + '\n'
-                    outfile.write(text)
+        with open(self.output_file, 'wb') as outfile:
+
+            # An empty input has no fingerprints and cannot be memory mapped
+            if self.finger_print_map:
+                # The input is mapped once, so every duplicate is a slice of the page cache
+                # instead of an open, seek and read on the input file
+                with open(self.input_file, 'rb') as input_file_fp, \
+                        mmap.mmap(input_file_fp.fileno(), 0, access=mmap.ACCESS_READ) as input_mm, \
+                        memoryview(input_mm) as input_view:
+
+                    # The fingerprint strings are read back from the objects with the extractor of the first line
+                    first_end = input_mm.find(b'\n')
+                    extract_finger_print = build_finger_print_extractor(input_mm[:len(input_mm) if first_end < 0
+                                                                                 else first_end])
+
+                    # Output lines of many fingerprints are assembled in one reused buffer, the objects are copied
+                    # into it straight from the mapping without creating a bytes object per duplicate
+                    buf = bytearray()
+                    for row in range(len(self.counts)):
+
+                        # Condition checks if duplicate exists for the fingerprint
+                        if self.counts[row] > 1:
+                            # The hashmap is keyed by the leading bytes of a fingerprint, so the lines of a row are
+                            # grouped by the fingerprint read back from each object. A row of colliding fingerprints
+                            # splits into one group per fingerprint
+                            groups = {}
+                            line_number = self.heads[row]
+                            while line_number != END_OF_LINES:
+                                start = self.starts[line_number]
+                                finger_print_str = extract_finger_print(input_mm, start,
+                                                                        start + self.lengths[line_number])
+                                groups.setdefault(finger_print_str, []).append(line_number)
+                                line_number = self.next_lines[line_number]
+
+                            for finger_print_str, line_numbers in groups.items():
+                                if len(line_numbers) < 2:
+                                    continue
+
+                                buf += b'{"fingerprint": "%s", "certificates": [' % finger_print_str
+                                for line_number in line_numbers:
+                                    start = self.starts[line_number]
+                                    buf += input_view[start:start + self.lengths[line_number]]
+                                    buf += b','
+                                # Replace the trailing comma with the closing brackets
+                                buf[-1:] = b']}\n'
+
+                            if len(buf) > WRITE_BUFFER_SIZE:
+                                outfile.write(buf)
+                                buf.clear()
+                    outfile.write(buf)
         print("Data writing completed  in: {0}".format(datetime.datetime.now() - start_time))
 
 